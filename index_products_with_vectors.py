@@ -1,44 +1,11 @@
-from sentence_transformers import SentenceTransformer
-from opensearchpy import OpenSearch
-from urllib.parse import urlparse
-import urllib3
-import os
-
-# Disable SSL warnings for self-signed certificates
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Connection settings (credentials optional)
-OPENSEARCH_URL = os.getenv('OPENSEARCH_URL', 'http://localhost:9200')
-OPENSEARCH_USERNAME = os.getenv('OPENSEARCH_USERNAME')
-OPENSEARCH_PASSWORD = os.getenv('OPENSEARCH_PASSWORD')
-VERIFY_CERTS_ENV = os.getenv('OPENSEARCH_VERIFY_CERTS')
-
-parsed = urlparse(OPENSEARCH_URL)
-host = parsed.hostname or 'localhost'
-port = parsed.port or (443 if parsed.scheme == 'https' else 9200)
-use_ssl = parsed.scheme == 'https'
-verify_certs = (
-    (VERIFY_CERTS_ENV.lower() in ('1', 'true', 'yes')) if isinstance(VERIFY_CERTS_ENV, str)
-    else use_ssl
+from common import (
+    EMBEDDING_DIMENSION, INDEX_NAME, VECTOR_DATA_TYPE,
+    clear_semantic_cache, embed, get_client, use_multi_process, vector_field_value
 )
+from opensearchpy.helpers import parallel_bulk
 
-# Initialize the embedding model (384 dimensions)
-print("Loading embedding model...")
-model = SentenceTransformer('all-MiniLM-L6-v2')
-print("Model loaded successfully!\n")
-
-print("Connecting to OpenSearch...")
-client = OpenSearch(
-    hosts=[{'host': host, 'port': port}],
-    http_auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD) if (OPENSEARCH_USERNAME and OPENSEARCH_PASSWORD) else None,
-    use_ssl=use_ssl,
-    verify_certs=verify_certs,
-    ssl_assert_hostname=verify_certs,
-    ssl_show_warn=verify_certs,
-)
-info = client.info()
-scheme = 'HTTPS' if use_ssl else 'HTTP'
-print(f"Connected via {scheme} to OpenSearch {info['version']['number']} at {host}:{port}\n")
+# Descriptions embedded per step while earlier steps are being indexed
+ENCODE_CHUNK_SIZE = 1024
 
 # Sample products
 products = [
@@ -72,22 +39,118 @@ products = [
     }
 ]
 
-# Generate embeddings and index products
-for product in products:
-    # Generate vector from description
-    vector = model.encode(product['description']).tolist()
-    
-    # Add vector to product
-    product['description_vector'] = vector
-    
-    # Index the product
-    response = client.index(
-        index='products_vector',
-        id=product['product_id'],
-        body=product
+
+def create_index(client):
+    """Create the index with the workshop mapping, tuned for the initial bulk load."""
+    description_vector = {
+        "type": "knn_vector",
+        "dimension": EMBEDDING_DIMENSION,
+        "method": {
+            "name": "hnsw",
+            "engine": "faiss",
+            "space_type": "innerproduct",
+            "parameters": {
+                "ef_construction": 128,
+                "m": 16
+            }
+        }
+    }
+    if VECTOR_DATA_TYPE == 'byte':
+        description_vector["data_type"] = "byte"
+
+    client.indices.create(
+        index=INDEX_NAME,
+        body={
+            "settings": {
+                "index": {
+                    "knn": True,
+                    # No refreshes or replica copies while loading; restored afterwards
+                    "refresh_interval": "-1",
+                    "number_of_replicas": 0
+                }
+            },
+            "mappings": {
+                "properties": {
+                    "product_id": {"type": "keyword"},
+                    "name": {"type": "text"},
+                    "description": {"type": "text"},
+                    "description_vector": description_vector,
+                    "category": {"type": "keyword"},
+                    "price": {"type": "double"}
+                }
+            }
+        }
     )
-    
-    print(f"Indexed {product['product_id']}: {response['result']}")
 
-print("\nAll products indexed successfully!")
 
+def generate_actions(products):
+    """Yield bulk actions, embedding the descriptions one chunk at a time.
+
+    parallel_bulk consumes this generator on its own feeder thread, so encoding
+    the next chunk overlaps with the _bulk requests for the previous ones.
+    """
+    # The multi-process pool is costly to start, so it gets the whole list at once
+    chunk_size = len(products) if use_multi_process(len(products)) else ENCODE_CHUNK_SIZE
+    for start in range(0, len(products), chunk_size):
+        chunk = products[start:start + chunk_size]
+        # Cached descriptions are skipped; misses are encoded in one batched call
+        vectors = embed([product['description'] for product in chunk])
+        for product, vector in zip(chunk, vectors):
+            yield {
+                "_index": INDEX_NAME,
+                "_id": product['product_id'],
+                "_source": {**product, 'description_vector': vector_field_value(vector)}
+            }
+
+
+def run(products=products):
+    client = get_client()
+
+    # Pause refreshes during the load; one refresh at the end makes the docs searchable
+    if client.indices.exists(index=INDEX_NAME):
+        current = client.indices.get_settings(
+            index=INDEX_NAME, name='index.refresh_interval', flat_settings=True
+        )
+        restore = {'refresh_interval': current[INDEX_NAME]['settings'].get('index.refresh_interval')}
+        client.indices.put_settings(index=INDEX_NAME, body={'index': {'refresh_interval': '-1'}})
+    else:
+        create_index(client)
+        # Back to the default refresh interval and one replica per shard
+        restore = {'refresh_interval': None, 'number_of_replicas': 1}
+
+    indexed = 0
+    failed = 0
+    try:
+        # Index with concurrent _bulk requests while the next chunk is encoded
+        for ok, item in parallel_bulk(
+            client,
+            generate_actions(products),
+            thread_count=8,
+            chunk_size=200,
+            queue_size=8,
+            raise_on_error=False,
+            request_timeout=60,
+        ):
+            if ok:
+                indexed += 1
+            else:
+                failed += 1
+                print(f"Failed to index: {item}")
+    finally:
+        # Cached search responses are stale once the index changes, even partially
+        clear_semantic_cache()
+        client.indices.refresh(index=INDEX_NAME)
+        client.indices.put_settings(index=INDEX_NAME, body={'index': restore})
+
+    print(f"Indexed {indexed} products")
+
+    if failed:
+        print(f"\n{failed} products failed to index")
+    else:
+        print("\nAll products indexed successfully!")
+
+
+# Worker processes started for encoding re-import this module, so the indexing
+# only runs when executed as a script
+if __name__ == '__main__':
+    run()
@@ -1,72 +1,134 @@
-from sentence_transformers import SentenceTransformer
-from opensearchpy import OpenSearch
-from urllib.parse import urlparse
-import urllib3
+from common import (
+    INDEX_NAME, VECTOR_DATA_TYPE, embed, get_client,
+    semantic_cache_lookup, semantic_cache_save, semantic_cache_store, vector_field_value
+)
+from opensearchpy.exceptions import HTTP_EXCEPTIONS, TransportError
+import numpy as np
 import os
 
-# Disable SSL warnings for self-signed certificates
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Connection settings (credentials optional)
-OPENSEARCH_URL = os.getenv('OPENSEARCH_URL', 'http://localhost:9200')
-OPENSEARCH_USERNAME = os.getenv('OPENSEARCH_USERNAME')
-OPENSEARCH_PASSWORD = os.getenv('OPENSEARCH_PASSWORD')
-VERIFY_CERTS_ENV = os.getenv('OPENSEARCH_VERIFY_CERTS')
-
-parsed = urlparse(OPENSEARCH_URL)
-host = parsed.hostname or 'localhost'
-port = parsed.port or (443 if parsed.scheme == 'https' else 9200)
-use_ssl = parsed.scheme == 'https'
-verify_certs = (
-    (VERIFY_CERTS_ENV.lower() in ('1', 'true', 'yes')) if isinstance(VERIFY_CERTS_ENV, str)
-    else use_ssl
-)
+# Threads for encoding a single short query. Too many threads spend more time
+# waking up than computing on 384-d matmuls; bulk indexing keeps torch's default.
+QUERY_THREADS = int(os.getenv('OMP_NUM_THREADS', str(min(8, os.cpu_count() or 1))))
 
-# Initialize the same model
-print("Loading embedding model...")
-model = SentenceTransformer('all-MiniLM-L6-v2')
-print("Model loaded successfully!\n")
-
-print("Connecting to OpenSearch...")
-client = OpenSearch(
-    hosts=[{'host': host, 'port': port}],
-    http_auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD) if (OPENSEARCH_USERNAME and OPENSEARCH_PASSWORD) else None,
-    use_ssl=use_ssl,
-    verify_certs=verify_certs,
-    ssl_assert_hostname=verify_certs,
-    ssl_show_warn=verify_certs,
-)
-info = client.info()
-scheme = 'HTTPS' if use_ssl else 'HTTP'
-print(f"Connected via {scheme} to OpenSearch {info['version']['number']} at {host}:{port}\n")
-
-# User's search query
-query_text = "noise blocking headphones"
-
-# Generate vector for the query
-query_vector = model.encode(query_text).tolist()
-
-# Search using the vector
-response = client.search(
-    index='products_vector',
-    body={
-        "size": 5,
-        "query": {
-            "knn": {
-                "description_vector": {
-                    "vector": query_vector,
-                    "k": 5
-                }
-            }
+# Weight of vector similarity against BM25 when re-ranking on the client;
+# 1.0 (default) keeps the plain k-NN ranking
+HYBRID_ALPHA = float(os.getenv('HYBRID_ALPHA', '1.0'))
+
+
+def rerank(query_vector, doc_vectors, text_scores, alpha):
+    """Blend cosine similarity and text scores for all candidates in one pass."""
+    return alpha * (doc_vectors @ query_vector) + (1 - alpha) * text_scores
+
+
+def hybrid_rerank(query_vector, knn_result, text_result, k):
+    """Merge the k-NN and BM25 candidates and re-rank them with HYBRID_ALPHA."""
+    candidates = {}
+    for hit in knn_result['hits']['hits'] + text_result['hits']['hits']:
+        candidates.setdefault(hit['_id'], hit)
+    hits = list(candidates.values())
+    if not hits:
+        return knn_result
+
+    # Scale BM25 scores into [0, 1] so they are comparable with cosine similarity
+    max_text_score = text_result['hits']['max_score'] or 1.0
+    text_scores_by_id = {
+        hit['_id']: hit['_score'] / max_text_score for hit in text_result['hits']['hits']
+    }
+    text_scores = np.array([text_scores_by_id.get(hit['_id'], 0.0) for hit in hits], dtype=np.float32)
+    doc_vectors = np.array([hit['_source'].pop('description_vector') for hit in hits], dtype=np.float32)
+    if VECTOR_DATA_TYPE == 'byte':
+        doc_vectors /= 127
+
+    scores = rerank(query_vector, doc_vectors, text_scores, HYBRID_ALPHA)
+    order = np.argsort(-scores)[:k]
+    reranked = []
+    for i in order:
+        hits[i]['_score'] = float(scores[i])
+        reranked.append(hits[i])
+    return {
+        'hits': {
+            'total': {'value': len(hits), 'relation': 'eq'},
+            'max_score': reranked[0]['_score'],
+            'hits': reranked,
         }
     }
-)
 
-# Print results
-print(f"Found {response['hits']['total']['value']} results:\n")
-for hit in response['hits']['hits']:
-    print(f"Score: {hit['_score']:.4f}")
-    print(f"Product: {hit['_source']['name']}")
-    print(f"Description: {hit['_source']['description']}")
-    print()
 
+def knn_search_batch(queries, k=5):
+    """Run a k-NN search for each query, sending all cache misses in one msearch.
+
+    With HYBRID_ALPHA below 1, each query also runs a BM25 match on the
+    description and the combined candidates are re-ranked on the client.
+    """
+    if not queries:
+        return []
+
+    hybrid = HYBRID_ALPHA < 1.0
+    vectors = embed(queries, num_threads=QUERY_THREADS)
+    responses = [semantic_cache_lookup(vector, k, HYBRID_ALPHA) for vector in vectors]
+    misses = [i for i, response in enumerate(responses) if response is None]
+    if not misses:
+        return responses
+
+    # Hybrid re-ranking needs more candidates, and their vectors
+    size = k * 4 if hybrid else k
+    source = True if hybrid else {"excludes": ["description_vector"]}
+    body = []
+    for i in misses:
+        body.append({"index": INDEX_NAME})
+        body.append({
+            "size": size,
+            "_source": source,
+            "query": {
+                "knn": {
+                    "description_vector": {
+                        "vector": vector_field_value(vectors[i]),
+                        "k": size
+                    }
+                }
+            }
+        })
+        if hybrid:
+            body.append({"index": INDEX_NAME})
+            body.append({
+                "size": size,
+                "query": {"match": {"description": queries[i]}}
+            })
+    results = get_client().msearch(body=body)['responses']
+
+    for n, i in enumerate(misses):
+        if hybrid:
+            knn_result, text_result = results[2 * n], results[2 * n + 1]
+            failed = next((r for r in (knn_result, text_result) if 'error' in r), None)
+            result = failed or hybrid_rerank(vectors[i], knn_result, text_result, k)
+        else:
+            result = results[n]
+        responses[i] = result
+        if 'error' not in result:
+            semantic_cache_store(vectors[i], k, HYBRID_ALPHA, result)
+    semantic_cache_save()
+    return responses
+
+
+def run(query_text):
+    # Search using the query vector, unless a near-identical query was answered before
+    response = knn_search_batch([query_text])[0]
+    if 'error' in response:
+        # Raise the same exception a plain search would, e.g. NotFoundError
+        status = response.get('status', 'N/A')
+        error = response['error']
+        error_type = error.get('type') if isinstance(error, dict) else error
+        raise HTTP_EXCEPTIONS.get(status, TransportError)(status, error_type, response)
+
+    # Print results
+    print(f"Found {response['hits']['total']['value']} results:\n")
+    for hit in response['hits']['hits']:
+        print(f"Score: {hit['_score']:.4f}")
+        print(f"Product: {hit['_source']['name']}")
+        print(f"Description: {hit['_source']['description']}")
+        print()
+
+
+if __name__ == '__main__':
+    # User's search query
+    run("noise blocking headphones")